@@ -17,13 +17,19 @@ Requirements:
 """
 
 import argparse
+import base64
+import concurrent.futures
+import http.client
 import json
 import math
 import os
+import shelve
 import sys
+import threading
 import time
+import urllib.parse
 import urllib.request
-import urllib.error
+from collections import defaultdict
 
 try:
     import psycopg2
@@ -37,95 +43,296 @@ except ImportError:
 # 0.0005° ≈ 55m latitude, ~41m longitude at 42°N
 DEFAULT_GRID_SIZE = 0.0005
 
+# Google Geocoding API allows 50 requests/second by default; stay well below it
+DEFAULT_QPS = 20
+
+# Local cache of Google results so interrupted runs don't pay for calls twice
+DEFAULT_CACHE_FILE = os.path.expanduser("~/.teslamate_geocache.db")
+
+# Google Maps API host; each worker thread keeps one connection open to it
+GOOGLE_MAPS_HOST = "maps.googleapis.com"
+
+# Retries for rate-limited (429/503/OVER_QUERY_LIMIT) API calls
+MAX_RETRIES = 3
+
+# Address columns filled from google_result_to_address, in INSERT order
+ADDRESS_COLUMNS = (
+    "display_name", "latitude", "longitude", "name", "house_number", "road",
+    "neighbourhood", "city", "county", "postcode", "state", "state_district",
+    "country", "raw",
+)
+
+# Built once at import; execute_values expands VALUES %s with one row per address
+INSERT_ADDRESSES_SQL = (
+    f"INSERT INTO addresses ({', '.join(ADDRESS_COLUMNS)}, "
+    "inserted_at, updated_at, osm_id, osm_type) VALUES %s RETURNING id"
+)
+INSERT_ADDRESS_TEMPLATE = (
+    "(" + ", ".join(f"%({column})s" for column in ADDRESS_COLUMNS)
+    + ", NOW(), NOW(), NULL, NULL)"
+)
+
+# One UPDATE ... FROM (VALUES ...) per record type, fed (address_id, record_id) rows
+UPDATE_SQL = {
+    "drive_start": """
+        UPDATE drives AS d SET start_address_id = v.aid
+        FROM (VALUES %s) AS v(aid, id)
+        WHERE d.id = v.id
+    """,
+    "drive_end": """
+        UPDATE drives AS d SET end_address_id = v.aid
+        FROM (VALUES %s) AS v(aid, id)
+        WHERE d.id = v.id
+    """,
+    "charging": """
+        UPDATE charging_processes AS c SET address_id = v.aid
+        FROM (VALUES %s) AS v(aid, id)
+        WHERE c.id = v.id
+    """,
+}
+
+
+class TokenBucket:
+    """Thread-safe token bucket that paces API calls across all workers."""
+
+    def __init__(self, max_rate):
+        self.max_rate = max_rate
+        self._set_rate(max_rate)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def _set_rate(self, rate):
+        # Never exceed the configured maximum, whatever the server advertises
+        self.refill_rate = min(rate, self.max_rate)
+        self.capacity = max(1.0, self.refill_rate)
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = max(0.0, now - self.last_refill)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_rate)
+        self.last_refill = max(now, self.last_refill)
+
+    def acquire(self):
+        """Block until a token is available and take it; False once stopped."""
+        while not self.stopped.is_set():
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.refill_rate
+                wait += max(0.0, self.last_refill - time.monotonic())
+            self.stopped.wait(wait)
+        return False
+
+    def stop(self):
+        """Release waiting workers without handing out further tokens."""
+        self.stopped.set()
+
+    def pause(self, seconds):
+        """Stop handing out tokens for the given number of seconds."""
+        with self.lock:
+            self.tokens = 0
+            self.last_refill = max(self.last_refill, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers):
+        """Slow down to the server's advertised X-RateLimit-* limits, if present."""
+        limit = headers.get("X-RateLimit-Limit")
+        remaining = headers.get("X-RateLimit-Remaining")
+        with self.lock:
+            try:
+                if limit and float(limit) > 0:
+                    self._set_rate(float(limit))
+                if remaining and float(remaining) >= 0:
+                    self.tokens = min(self.tokens, float(remaining))
+            except ValueError:
+                pass
+
+
+def retry_after_seconds(headers, attempt):
+    """Seconds to wait before retrying: Retry-After if given, else exponential backoff."""
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return 2 ** attempt
 
-def snap_to_grid(lat, lng, grid_size):
-    """Snap coordinates to the nearest grid cell."""
-    return (
-        round(float(lat) / grid_size) * grid_size,
-        round(float(lng) / grid_size) * grid_size,
-    )
 
+_http = threading.local()
+
+
+def open_maps_connection():
+    """Open an HTTPS connection to the Maps API, tunnelling through HTTPS_PROXY if set."""
+    # Honour the same proxy settings (HTTPS_PROXY / NO_PROXY) urllib would use
+    proxy = urllib.request.getproxies().get("https")
+    if not proxy or urllib.request.proxy_bypass(GOOGLE_MAPS_HOST):
+        return http.client.HTTPSConnection(GOOGLE_MAPS_HOST, timeout=10)
+
+    parts = urllib.parse.urlsplit(proxy if "://" in proxy else f"http://{proxy}")
+    headers = {}
+    if parts.username:
+        credentials = (
+            f"{urllib.parse.unquote(parts.username)}:"
+            f"{urllib.parse.unquote(parts.password or '')}"
+        )
+        headers["Proxy-Authorization"] = (
+            "Basic " + base64.b64encode(credentials.encode()).decode()
+        )
+    conn = http.client.HTTPSConnection(parts.hostname, parts.port or 80, timeout=10)
+    conn.set_tunnel(GOOGLE_MAPS_HOST, 443, headers=headers)
+    return conn
+
+
+def google_api_get(path):
+    """GET a path from the Maps API over this thread's keep-alive connection."""
+    for reconnect in (False, True):
+        conn = getattr(_http, "conn", None)
+        fresh = conn is None
+        if fresh:
+            conn = _http.conn = open_maps_connection()
+        try:
+            conn.request("GET", path)
+            resp = conn.getresponse()
+            return resp.status, resp.headers, resp.read()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            _http.conn = None
+            # A reused connection may have been closed by the server; retry once
+            if fresh or reconnect:
+                raise
+
+
+def reverse_geocode_google(lat, lng, api_key, bucket):
+    """Call Google Maps Reverse Geocoding API, retrying when rate limited."""
+    path = f"/maps/api/geocode/json?latlng={lat},{lng}&key={api_key}"
+    for attempt in range(MAX_RETRIES + 1):
+        # A stopped run must not spend more paid API calls
+        if not bucket.acquire():
+            return None
+        try:
+            status, headers, body = google_api_get(path)
+        except (http.client.HTTPException, OSError) as e:
+            print(f"  Connection error: {e}")
+            return None
+
+        if status in (429, 503) and attempt < MAX_RETRIES:
+            wait = retry_after_seconds(headers, attempt + 1)
+            print(f"  HTTP {status}, retrying in {wait:.0f}s")
+            bucket.pause(wait)
+            continue
+        if status != 200:
+            print(f"  HTTP {status}: {body.decode(errors='replace')[:200]}")
+            return None
+
+        bucket.update_from_headers(headers)
+        data = json.loads(body.decode())
+
+        if data.get("status") == "OVER_QUERY_LIMIT" and attempt < MAX_RETRIES:
+            wait = 2 ** (attempt + 1)
+            print(f"  API status: OVER_QUERY_LIMIT, retrying in {wait}s")
+            bucket.pause(wait)
+            continue
+
+        if data.get("status") != "OK" or not data.get("results"):
+            print(f"  API status: {data.get('status')} — {data.get('error_message', '')}")
+            return None
+
+        return data["results"][0]
+
+    return None
 
-def reverse_geocode_google(lat, lng, api_key):
-    """Call Google Maps Reverse Geocoding API."""
-    url = (
-        f"https://maps.googleapis.com/maps/api/geocode/json"
-        f"?latlng={lat},{lng}&key={api_key}"
-    )
-    req = urllib.request.Request(url)
-    try:
-        with urllib.request.urlopen(req, timeout=10) as resp:
-            data = json.loads(resp.read().decode())
-    except urllib.error.HTTPError as e:
-        body = e.read().decode() if e.fp else ""
-        print(f"  HTTP {e.code}: {body[:200]}")
-        return None
-    except urllib.error.URLError as e:
-        print(f"  URL error: {e.reason}")
-        return None
 
-    if data.get("status") != "OK" or not data.get("results"):
-        print(f"  API status: {data.get('status')} — {data.get('error_message', '')}")
-        return None
+def geocode_cluster(records, api_key, bucket):
+    """Geocode a cluster from its first record's position (runs in a worker thread)."""
+    _, _, actual_lat, actual_lng = records[0]
+    return reverse_geocode_google(actual_lat, actual_lng, api_key, bucket)
 
-    return data["results"][0]
 
+def cache_key(cell, grid_size):
+    """Key for a grid cell in the local geocode cache."""
+    return f"{cell[0] * grid_size:.6f},{cell[1] * grid_size:.6f}"
 
-def extract_component(result, component_type):
-    """Extract a specific address component from a Google Maps result."""
+
+def iter_geocoded(cells_to_geocode, grid_size, cache, executor, api_key, bucket, futures):
+    """Yield (cell, result, from_cache) for every cell as results become available.
+
+    Submitted API calls are recorded in ``futures`` (future -> cell) so the
+    caller can still collect finished results if the run is abandoned.
+    """
+    cached = []
+    for cell, records in cells_to_geocode.items():
+        result = cache.get(cache_key(cell, grid_size))
+        if result is not None:
+            cached.append((cell, result))
+        else:
+            futures[executor.submit(geocode_cluster, records, api_key, bucket)] = cell
+    # Cache hits are served while the API calls are already in flight
+    for cell, result in cached:
+        yield cell, result, True
+    for future in concurrent.futures.as_completed(futures):
+        yield futures[future], future.result(), False
+
+
+def cache_finished_results(futures, cache, grid_size):
+    """Cache every API result that completed, so a rerun doesn't pay for it again."""
+    for future, cell in futures.items():
+        if future.done() and not future.cancelled() and future.exception() is None:
+            result = future.result()
+            if result:
+                cache[cache_key(cell, grid_size)] = result
+
+
+def components_by_type(result):
+    """Map each address component type to its long name, in one pass over the result."""
+    components = {}
     for comp in result.get("address_components", []):
-        if component_type in comp.get("types", []):
-            return comp.get("long_name")
-    return None
+        for component_type in comp.get("types", []):
+            # Keep the first component listed for each type
+            components.setdefault(component_type, comp.get("long_name"))
+    return components
 
 
 def google_result_to_address(result, grid_lat, grid_lng):
     """Convert a Google Maps geocoding result to a TeslaMate address dict."""
+    components = components_by_type(result)
     return {
         "display_name": result.get("formatted_address", ""),
         "latitude": round(grid_lat, 6),
         "longitude": round(grid_lng, 6),
-        "name": extract_component(result, "point_of_interest")
-        or extract_component(result, "premise")
-        or extract_component(result, "route"),
-        "house_number": extract_component(result, "street_number"),
-        "road": extract_component(result, "route"),
+        "name": components.get("point_of_interest")
+        or components.get("premise")
+        or components.get("route"),
+        "house_number": components.get("street_number"),
+        "road": components.get("route"),
         "neighbourhood": (
-            extract_component(result, "neighborhood")
-            or extract_component(result, "sublocality")
+            components.get("neighborhood")
+            or components.get("sublocality")
         ),
         "city": (
-            extract_component(result, "locality")
-            or extract_component(result, "sublocality_level_1")
+            components.get("locality")
+            or components.get("sublocality_level_1")
         ),
-        "county": extract_component(result, "administrative_area_level_2"),
-        "postcode": extract_component(result, "postal_code"),
-        "state": extract_component(result, "administrative_area_level_1"),
-        "state_district": extract_component(result, "administrative_area_level_3"),
-        "country": extract_component(result, "country"),
-        "raw": json.dumps(result),
+        "county": components.get("administrative_area_level_2"),
+        "postcode": components.get("postal_code"),
+        "state": components.get("administrative_area_level_1"),
+        "state_district": components.get("administrative_area_level_3"),
+        "country": components.get("country"),
+        "raw": psycopg2.extras.Json(result),
     }
 
 
-def insert_address(cur, addr):
-    """Insert a new address into the addresses table, return its ID."""
-    cur.execute(
-        """
-        INSERT INTO addresses (
-            display_name, latitude, longitude, name, house_number, road,
-            neighbourhood, city, county, postcode, state, state_district,
-            country, raw, inserted_at, updated_at, osm_id, osm_type
-        ) VALUES (
-            %(display_name)s, %(latitude)s, %(longitude)s, %(name)s,
-            %(house_number)s, %(road)s, %(neighbourhood)s, %(city)s,
-            %(county)s, %(postcode)s, %(state)s, %(state_district)s,
-            %(country)s, %(raw)s, NOW(), NOW(), NULL, NULL
-        )
-        RETURNING id
-        """,
-        addr,
+def insert_addresses(cur, addrs):
+    """Insert new addresses into the addresses table, return their IDs in order."""
+    rows = psycopg2.extras.execute_values(
+        cur,
+        INSERT_ADDRESSES_SQL,
+        addrs,
+        template=INSERT_ADDRESS_TEMPLATE,
+        page_size=len(addrs),
+        fetch=True,
     )
-    return cur.fetchone()[0]
+    return [row[0] for row in rows]
 
 
 def find_placeholder_id(cur):
@@ -137,90 +344,112 @@ def find_placeholder_id(cur):
     return row[0] if row else None
 
 
-def get_pending_records(cur, placeholder_id):
-    """Get all records that need geocoding, grouped by type."""
-    records = []
+def get_pending_records(conn, placeholder_id):
+    """Stream all records that need geocoding as (id, type, lat, lng) rows."""
+    # Server-side cursor: rows arrive in itersize chunks instead of all at once
+    with conn.cursor(name="pending_records") as cur:
+        cur.itersize = 10_000
+        cur.execute(
+            """
+            SELECT d.id, 'drive_start' AS type, p.latitude, p.longitude
+            FROM drives d
+            JOIN positions p ON d.start_position_id = p.id
+            WHERE d.start_address_id = %s
+            UNION ALL
+            SELECT d.id, 'drive_end' AS type, p.latitude, p.longitude
+            FROM drives d
+            JOIN positions p ON d.end_position_id = p.id
+            WHERE d.end_address_id = %s
+            UNION ALL
+            SELECT c.id, 'charging' AS type, p.latitude, p.longitude
+            FROM charging_processes c
+            JOIN positions p ON c.position_id = p.id
+            WHERE c.address_id = %s
+            """,
+            (placeholder_id, placeholder_id, placeholder_id),
+        )
+        yield from cur
 
-    # Drive start addresses
-    cur.execute(
-        """
-        SELECT d.id, 'drive_start' AS type, p.latitude, p.longitude
-        FROM drives d
-        JOIN positions p ON d.start_position_id = p.id
-        WHERE d.start_address_id = %s
-        """,
-        (placeholder_id,),
-    )
-    records.extend(cur.fetchall())
 
-    # Drive end addresses
-    cur.execute(
-        """
-        SELECT d.id, 'drive_end' AS type, p.latitude, p.longitude
-        FROM drives d
-        JOIN positions p ON d.end_position_id = p.id
-        WHERE d.end_address_id = %s
-        """,
-        (placeholder_id,),
-    )
-    records.extend(cur.fetchall())
+def cluster_records(pending, grid_size):
+    """Group pending records by grid cell and count them by type."""
+    counts = {"drive_start": 0, "drive_end": 0, "charging": 0}
+    clusters = defaultdict(list)  # grid_cell -> [(record_id, record_type, lat, lng), ...]
+    for record_id, record_type, lat, lng in pending:
+        counts[record_type] += 1
+        # Convert the numeric columns once; clusters carry plain floats from here on
+        lat = float(lat)
+        lng = float(lng)
+        # Integer cell indices: exact dict keys, no float equality concerns
+        cell = (round(lat / grid_size), round(lng / grid_size))
+        clusters[cell].append((record_id, record_type, lat, lng))
+    return dict(clusters), counts
+
 
-    # Charging process addresses
+def match_existing_addresses(cur, cells, placeholder_id, grid_size):
+    """Map integer grid cells to an existing address in the same cell, matched server-side."""
+    if not cells:
+        return {}
+    # Cell indices are recomputed in SQL with the same float8 arithmetic as
+    # cluster_records so both sides round identically
     cur.execute(
         """
-        SELECT c.id, 'charging' AS type, p.latitude, p.longitude
-        FROM charging_processes c
-        JOIN positions p ON c.position_id = p.id
-        WHERE c.address_id = %s
+        SELECT DISTINCT ON (v.clat, v.clng) v.clat, v.clng, a.id
+        FROM unnest(%s::bigint[], %s::bigint[]) AS v(clat, clng)
+        JOIN addresses a
+            ON round(a.latitude::float8 / %s::float8)::bigint = v.clat
+            AND round(a.longitude::float8 / %s::float8)::bigint = v.clng
+        WHERE a.id != %s
+        ORDER BY v.clat, v.clng, a.id
         """,
-        (placeholder_id,),
+        (
+            [cell_lat for cell_lat, _ in cells],
+            [cell_lng for _, cell_lng in cells],
+            grid_size,
+            grid_size,
+            placeholder_id,
+        ),
     )
-    records.extend(cur.fetchall())
-
-    return records
+    # Keep the lowest address ID per cell (typically the one TeslaMate created)
+    return {(clat, clng): addr_id for clat, clng, addr_id in cur.fetchall()}
 
 
-def get_existing_addresses(cur, placeholder_id):
-    """Get all existing non-placeholder addresses with their grid cells."""
-    cur.execute(
-        """
-        SELECT id, latitude, longitude
-        FROM addresses
-        WHERE id != %s AND latitude IS NOT NULL AND longitude IS NOT NULL
-        """,
-        (placeholder_id,),
+def queue_updates(records, address_id, updates):
+    """Buffer a (record_type, record_id, address_id) update for each record in a cluster."""
+    updates.extend(
+        (record_type, record_id, address_id) for record_id, record_type, _, _ in records
     )
-    return cur.fetchall()
 
 
-def build_existing_grid(existing_addresses, grid_size):
-    """Build a mapping of grid cells to existing address IDs."""
-    grid = {}
-    for addr_id, lat, lng in existing_addresses:
-        cell = snap_to_grid(lat, lng, grid_size)
-        # Keep the first address found per cell (typically the one TeslaMate created)
-        if cell not in grid:
-            grid[cell] = addr_id
-    return grid
+def apply_updates(cur, updates):
+    """Apply all buffered updates with a single statement per record type."""
+    rows_by_type = defaultdict(list)
+    for record_type, record_id, address_id in updates:
+        rows_by_type[record_type].append((address_id, record_id))
+    for record_type, rows in rows_by_type.items():
+        psycopg2.extras.execute_values(
+            cur, UPDATE_SQL[record_type], rows, page_size=len(rows)
+        )
 
 
-def update_records(cur, record_type, record_id, address_id):
-    """Update a drive or charging process with the resolved address ID."""
-    if record_type == "drive_start":
-        cur.execute(
-            "UPDATE drives SET start_address_id = %s WHERE id = %s",
-            (address_id, record_id),
-        )
-    elif record_type == "drive_end":
-        cur.execute(
-            "UPDATE drives SET end_address_id = %s WHERE id = %s",
-            (address_id, record_id),
-        )
-    elif record_type == "charging":
-        cur.execute(
-            "UPDATE charging_processes SET address_id = %s WHERE id = %s",
-            (address_id, record_id),
-        )
+def apply_updates_keeping_addresses(conn, cur, updates):
+    """Apply Phase 2 updates; if that fails, commit the geocoded addresses before re-raising."""
+    try:
+        apply_updates(cur, updates)
+    except BaseException:
+        print()
+        print("  Updating records failed — keeping geocoded addresses for the next run")
+        cur.execute("ROLLBACK TO SAVEPOINT geocode_batch")
+        conn.commit()
+        raise
+
+
+def write_geocoded(cur, addrs, clusters):
+    """Insert geocoded addresses, return the record updates that point at them."""
+    updates = []
+    for addr_id, records in zip(insert_addresses(cur, addrs), clusters):
+        queue_updates(records, addr_id, updates)
+    return updates
 
 
 def main():
@@ -262,11 +491,33 @@ def main():
         action="store_true",
         help="Preview what would happen without making changes",
     )
+    parser.add_argument(
+        "--qps",
+        type=float,
+        default=DEFAULT_QPS,
+        help=f"Maximum API requests per second across all workers (default: {DEFAULT_QPS})",
+    )
     parser.add_argument(
         "--delay",
         type=float,
-        default=0.1,
-        help="Delay between API calls in seconds (default: 0.1)",
+        default=0,
+        help="Minimum delay between API calls in seconds, caps --qps (default: 0)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=5,
+        help="Number of concurrent API requests (default: 5)",
+    )
+    parser.add_argument(
+        "--cache-file",
+        default=DEFAULT_CACHE_FILE,
+        help=f"Local cache of API results (default: {DEFAULT_CACHE_FILE})",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't read or write the local API result cache",
     )
     args = parser.parse_args()
 
@@ -280,6 +531,14 @@ def main():
         print("  Set DATABASE_PASS env var or use --db-pass")
         sys.exit(1)
 
+    if args.qps <= 0:
+        print("Error: --qps must be greater than 0.")
+        sys.exit(1)
+
+    if args.concurrency < 1:
+        print("Error: --concurrency must be at least 1.")
+        sys.exit(1)
+
     grid_meters_lat = args.grid_size * 111_000
     grid_meters_lng = args.grid_size * 111_000 * math.cos(math.radians(42))
     print(f"=== TeslaMate Smart Geocoding ===")
@@ -312,53 +571,43 @@ def main():
 
     print(f"Placeholder address ID: {placeholder_id}")
 
-    # Get pending records
-    pending = get_pending_records(cur, placeholder_id)
-    if not pending:
+    # Get pending records and build grid clusters from them in one pass
+    clusters, counts = cluster_records(
+        get_pending_records(conn, placeholder_id), args.grid_size
+    )
+    total_records = sum(counts.values())
+    if not total_records:
         print("No pending records found. Everything is already geocoded.")
         cur.close()
         conn.close()
         return
 
-    drive_starts = sum(1 for _, t, _, _ in pending if t == "drive_start")
-    drive_ends = sum(1 for _, t, _, _ in pending if t == "drive_end")
-    charging = sum(1 for _, t, _, _ in pending if t == "charging")
-    print(f"Pending records: {len(pending)} total")
-    print(f"  Drive starts: {drive_starts}")
-    print(f"  Drive ends:   {drive_ends}")
-    print(f"  Charging:     {charging}")
+    print(f"Pending records: {total_records} total")
+    print(f"  Drive starts: {counts['drive_start']}")
+    print(f"  Drive ends:   {counts['drive_end']}")
+    print(f"  Charging:     {counts['charging']}")
     print()
 
-    # Build grid clusters from pending records
-    clusters = {}  # grid_cell -> [(record_id, record_type, lat, lng), ...]
-    for record_id, record_type, lat, lng in pending:
-        cell = snap_to_grid(lat, lng, args.grid_size)
-        if cell not in clusters:
-            clusters[cell] = []
-        clusters[cell].append((record_id, record_type, lat, lng))
-
     print(f"Unique location clusters (~{grid_meters_lat:.0f}m): {len(clusters)}")
     print()
 
-    # Get existing addresses and build grid
-    existing = get_existing_addresses(cur, placeholder_id)
-    existing_grid = build_existing_grid(existing, args.grid_size)
-    print(f"Existing geocoded addresses: {len(existing)}")
-    print()
+    # Look up existing addresses in the same grid cells
+    existing_grid = match_existing_addresses(
+        cur, list(clusters), placeholder_id, args.grid_size
+    )
 
     # Phase 1: Match existing addresses
     print("=== Phase 1: Matching existing addresses ===")
     matched_from_existing = 0
     records_updated_phase1 = 0
 
+    updates = []  # (record_type, record_id, address_id)
     cells_to_geocode = {}
     for cell, records in clusters.items():
         if cell in existing_grid:
             addr_id = existing_grid[cell]
             matched_from_existing += 1
-            if not args.dry_run:
-                for record_id, record_type, _, _ in records:
-                    update_records(cur, record_type, record_id, addr_id)
+            queue_updates(records, addr_id, updates)
             records_updated_phase1 += len(records)
         else:
             cells_to_geocode[cell] = records
@@ -368,8 +617,10 @@ def main():
     print(f"  Remaining: {len(cells_to_geocode)} locations need geocoding")
     print()
 
+    # Phase 1 matches don't depend on the API; write them before any savepoint
     if not args.dry_run:
-        conn.commit()
+        apply_updates(cur, updates)
+        updates = []
 
     # Phase 2: Geocode remaining locations
     print("=== Phase 2: Geocoding new locations ===")
@@ -384,48 +635,101 @@ def main():
             conn.close()
             sys.exit(1)
 
+        pending_inserts = []  # address dicts awaiting INSERT
+        pending_clusters = []  # records for each entry in pending_inserts
         api_calls = 0
         api_errors = 0
+        cache_hits = 0
         records_updated_phase2 = 0
         total_cells = len(cells_to_geocode)
-
-        for i, (cell, records) in enumerate(cells_to_geocode.items(), 1):
-            grid_lat, grid_lng = cell
-            pct = i / total_cells * 100
-
-            # Pick a representative coordinate (first record's actual position)
-            _, _, actual_lat, actual_lng = records[0]
-
-            sys.stdout.write(
-                f"\r  [{i}/{total_cells}] ({pct:.0f}%) Geocoding ({float(actual_lat):.4f}, {float(actual_lng):.4f})..."
-            )
-            sys.stdout.flush()
-
-            result = reverse_geocode_google(
-                float(actual_lat), float(actual_lng), args.api_key
+        bucket = TokenBucket(
+            min(args.qps, 1 / args.delay) if args.delay > 0 else args.qps
+        )
+        cache = executor = None
+        futures = {}  # in-flight API calls, future -> cell
+
+        # One transaction for the whole run; a savepoint after each written
+        # batch marks the progress to keep if Phase 2 is interrupted
+        cur.execute("SAVEPOINT geocode_batch")
+        try:
+            cache = {} if args.no_cache else shelve.open(args.cache_file)
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency)
+
+            # Database and cache work stays on the main thread
+            geocoded = iter_geocoded(
+                cells_to_geocode, args.grid_size, cache, executor, args.api_key, bucket,
+                futures,
             )
-            api_calls += 1
-
-            if result:
-                addr = google_result_to_address(result, grid_lat, grid_lng)
-                addr_id = insert_address(cur, addr)
-
-                for record_id, record_type, _, _ in records:
-                    update_records(cur, record_type, record_id, addr_id)
-                records_updated_phase2 += len(records)
-
-                # Commit every 50 addresses to avoid losing progress
-                if api_calls % 50 == 0:
-                    conn.commit()
+            for i, (cell, result, from_cache) in enumerate(geocoded, 1):
+                records = cells_to_geocode[cell]
+                grid_lat = cell[0] * args.grid_size
+                grid_lng = cell[1] * args.grid_size
+                pct = i / total_cells * 100
+                _, _, actual_lat, actual_lng = records[0]
+
+                sys.stdout.write(
+                    f"\r  [{i}/{total_cells}] ({pct:.0f}%) Geocoded ({actual_lat:.4f}, {actual_lng:.4f})..."
+                )
+                sys.stdout.flush()
+
+                if from_cache:
+                    cache_hits += 1
+                else:
+                    api_calls += 1
+                    if result:
+                        cache[cache_key(cell, args.grid_size)] = result
+
+                if result:
+                    pending_inserts.append(google_result_to_address(result, grid_lat, grid_lng))
+                    pending_clusters.append(records)
+                    records_updated_phase2 += len(records)
+
+                    # Write every 50 addresses and move the savepoint past them;
+                    # their updates are only queued once the savepoint covers them
+                    if len(pending_inserts) >= 50:
+                        batch_updates = write_geocoded(cur, pending_inserts, pending_clusters)
+                        cur.execute(
+                            "RELEASE SAVEPOINT geocode_batch; SAVEPOINT geocode_batch"
+                        )
+                        updates.extend(batch_updates)
+                        pending_inserts, pending_clusters = [], []
+                else:
+                    api_errors += 1
+
+            if pending_inserts:
+                batch_updates = write_geocoded(cur, pending_inserts, pending_clusters)
+                cur.execute("RELEASE SAVEPOINT geocode_batch; SAVEPOINT geocode_batch")
+                updates.extend(batch_updates)
+        except BaseException as e:
+            # Stop API calls before the potentially long rollback and UPDATE,
+            # then keep whatever the workers already paid for
+            bucket.stop()
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+                if cache is not None:
+                    cache_finished_results(futures, cache, args.grid_size)
+            print()
+            if isinstance(e, KeyboardInterrupt):
+                print("  Interrupted — saving progress up to the last written batch")
             else:
-                api_errors += 1
+                print(f"  Failed ({e!r}) — saving progress up to the last written batch")
+            cur.execute("ROLLBACK TO SAVEPOINT geocode_batch")
+            apply_updates_keeping_addresses(conn, cur, updates)
+            conn.commit()
+            raise
+        finally:
+            bucket.stop()
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+            if cache is not None and not args.no_cache:
+                cache.close()
 
-            if args.delay > 0:
-                time.sleep(args.delay)
+        # Outside the try above so a failed UPDATE is never replayed by its handler
+        apply_updates_keeping_addresses(conn, cur, updates)
 
-        conn.commit()
         print()
         print(f"  API calls: {api_calls} ({api_errors} errors)")
+        print(f"  Cache hits: {cache_hits}")
         print(f"  Records updated: {records_updated_phase2}")
         print()
 
@@ -433,28 +737,39 @@ def main():
     print("=== Phase 3: Summary ===")
 
     if not args.dry_run:
-        # Check if placeholder is still referenced
+        # Check if placeholder is still referenced; each EXISTS stops at the
+        # first matching row instead of counting them all
         cur.execute(
             """
-            SELECT COUNT(*) FROM (
-                SELECT 1 FROM drives WHERE start_address_id = %s
-                UNION ALL SELECT 1 FROM drives WHERE end_address_id = %s
-                UNION ALL SELECT 1 FROM charging_processes WHERE address_id = %s
-            ) refs
+            SELECT EXISTS (SELECT 1 FROM drives WHERE start_address_id = %s)
+                OR EXISTS (SELECT 1 FROM drives WHERE end_address_id = %s)
+                OR EXISTS (SELECT 1 FROM charging_processes WHERE address_id = %s)
             """,
             (placeholder_id, placeholder_id, placeholder_id),
         )
-        remaining = cur.fetchone()[0]
+        still_referenced = cur.fetchone()[0]
 
-        if remaining == 0:
+        if not still_referenced:
             print(f"  Deleting placeholder address (ID {placeholder_id})...")
             cur.execute("DELETE FROM addresses WHERE id = %s", (placeholder_id,))
-            conn.commit()
             print("  Placeholder removed.")
         else:
+            # Rare path: count the references so the report is exact
+            cur.execute(
+                """
+                SELECT COUNT(*) FROM (
+                    SELECT 1 FROM drives WHERE start_address_id = %s
+                    UNION ALL SELECT 1 FROM drives WHERE end_address_id = %s
+                    UNION ALL SELECT 1 FROM charging_processes WHERE address_id = %s
+                ) refs
+                """,
+                (placeholder_id, placeholder_id, placeholder_id),
+            )
+            remaining = cur.fetchone()[0]
             print(f"  {remaining} records still reference placeholder (errors during geocoding)")
 
-    total_records = len(pending)
+        conn.commit()
+
     print()
     print(f"  Total records processed: {total_records}")
     print(f"  Resolved from existing: {records_updated_phase1} ({matched_from_existing} locations)")